@@ -1,25 +1,65 @@
 import streamlit as st
 import fitz  # PyMuPDF
-from openai import OpenAI
-from PIL import Image
-import io
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+import httpx  # openai 自带依赖
 import re
+import asyncio
+import itertools
+import functools
+import threading
+import queue
 import base64
+import atexit
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import os
 import subprocess
 import tempfile
 import shutil
 import platform
+import pathlib
+import multiprocessing
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import streamlit.components.v1 as components
+from pdf_layout import render_page_image, layout_page, fill_images, open_worker_doc, extract_worker_page
+try:
+    from weasyprint import HTML as WeasyHTML  # 可选：进程内 PDF 引擎
+except ImportError:
+    WeasyHTML = None
 
 # --- 0. 配置部分 ---
 try:
     API_KEY = st.secrets["DEEPSEEK_API_KEY"]
 except:
     API_KEY = "sk-xxxxxxxx" # 本地测试请填入真实Key
+# 多 Key 轮询：secrets 里可配 DEEPSEEK_API_KEYS = ["sk-a", "sk-b"]，叠加各 Key 的限流额度
+try:
+    USER_KEYS = list(st.secrets["DEEPSEEK_API_KEYS"])
+except:
+    USER_KEYS = []
+API_KEYS = [k for k in USER_KEYS if k.startswith("sk-")] or [API_KEY]
 
 BASE_URL = "https://api.deepseek.com"
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+MODEL = "deepseek-chat"
+MAX_CONCURRENCY = 12  # 整个进程同时在途的翻译请求上限（所有会话、所有页共享），防止触发限流
+KEEPALIVE_EXPIRY = 90  # 空闲连接保留秒数
+PAGE_CONCURRENCY = 4  # 同时翻译的页数，每页内部再合批
+PRINT_CHUNK_PAGES = 4  # 导出时每翻译完这么多页就先送去打印
+PRINT_WORKERS = 2  # Chrome 同时打印的段数
+PRINT_SPLIT_PAGES = 20  # Chrome 导出达到这么多页才拆段并行打印，小文档多一次冷启动不划算
+CHROME_TIMEOUT = 90  # 单次打印上限（秒），Chrome 卡死时不至于挂住整个会话
+BATCH_MARK = "<<<{}>>>"  # 合批翻译时每段开头的编号标记，按编号对齐译文
+BATCH_MAX_CHARS = 6000  # 每批原文字数上限，限制单次生成的时长
+BATCH_MAX_ITEMS = 40  # 每批段数上限：标题、标签等短块不再因段数先到顶而把一页拆成好几次请求
+PREVIEW_DPI = 108  # 左栏原文预览，屏幕显示用
+PREVIEW_QUALITY = 80  # 左栏预览图 JPEG 质量
+PROMPT_VERSION = "v3"  # 修改提示词后递增，避免命中旧译文
+MEMO_SIZE = 4096  # 进程内 LRU 条数
+MEMO_MAX_CHARS = 8000  # 超长译文只进 sqlite，不占进程内存
+CACHE_PATH = os.path.join(tempfile.gettempdir(), "trans_cache.db")  # 跨会话持久的译文缓存
 
 # 1. 界面配置：网页标题依然叫“光学室专用版”，有排面！
 st.set_page_config(page_title="光学室学术论文翻译专用版", page_icon="🔬", layout="wide")
@@ -69,146 +109,609 @@ COMMON_CSS = """
     }
 </style>
 """
+# 模块加载时压缩一次：去注释、合并空白，导出的每份 HTML 都少带这些字节
+COMMON_CSS = re.sub(r'\s*([{};,])\s*', r'\1', re.sub(r'\s+', ' ', re.sub(r'/\*.*?\*/', '', COMMON_CSS, flags=re.S))).strip()
 
 MATHJAX_SCRIPT = """
 <script>
 MathJax = { tex: { inlineMath: [['$', '$'], ['\\(', '\\)']] }, svg: { fontCache: 'global' } };
 </script>
-<script id="MathJax-script" async src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
+<script id="MathJax-script" async src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-svg.js"></script>
 """
+# 输出用 SVG：公式直接画成路径，不用再下载 MathJax 的 woff 字体、等字体就绪，打印排版更快
+# 导出用本地 MathJax，打印时不再走 CDN。目录约定（和 main.py 同级）：
+#   static/mathjax/tex-svg.js              ← mathjax@3 npm 包里 es5/ 目录的全部内容原样拷过来
+#   static/mathjax/input/tex/extensions/   ← 按需加载的 TeX 扩展，和 tex-svg.js 一起保留
+# 例如：npm pack mathjax@3 && tar xzf mathjax-3.*.tgz && cp -r package/es5 static/mathjax
+# 没放就继续用 CDN。网页预览在用户浏览器里渲染，读不到服务器本地文件，始终用 CDN
+_MATHJAX_LOCAL = pathlib.Path(__file__).resolve().parent / "static" / "mathjax" / "tex-svg.js"
+EXPORT_MATHJAX_SCRIPT = (MATHJAX_SCRIPT.replace("https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-svg.js", _MATHJAX_LOCAL.as_uri())
+                         if _MATHJAX_LOCAL.exists() else MATHJAX_SCRIPT)
 
 # --- 2. 核心逻辑 (保持不变) ---
-def image_to_base64(pil_image):
-    buff = io.BytesIO()
-    pil_image.save(buff, format="PNG")
-    img_str = base64.b64encode(buff.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
-
-def is_header_or_footer(rect, page_height):
-    if rect.y1 < 50: return True
-    if rect.y0 > page_height - 50: return True
-    return False
-
-def is_caption_node(text):
-    text = text.strip()
-    return text.startswith("Fig.") or (text.startswith("Figure") and re.match(r'^Figure\s?\d+[.:]', text))
-
-def translate_text(text, is_caption=False):
-    if len(text.strip()) < 2: return text
-    sys_prompt = """你是一个专业的物理学术翻译。请将文本翻译成流畅的学术中文。
-    【规则】
-    1. 保持学术严谨性。
-    2. 公式必须用 $...$ 或 $$...$$ 包裹。
-    3. 直接输出译文，不要加任何前缀或解释。
-    """
-    if is_caption: sys_prompt += " (这是图注，请保留 Figure 编号)"
+# 提示词与替换表在模块加载时一次成型，热循环里不再重复拼接
+# 所有请求共用同一条逐字节不变的系统提示词，命中 DeepSeek 服务端前缀缓存；图注标记放到 user 消息里
+_SYS_PROMPT = f"""你是一个专业的物理学术翻译。请将文本翻译成流畅的学术中文。
+【规则】
+1. 保持学术严谨性。
+2. 公式必须用 $...$ 或 $$...$$ 包裹。
+3. 直接输出译文，不要加任何前缀或解释。
+4. 以【图注】开头的段落是图注，请保留 Figure 编号，输出时去掉【图注】标记。
+5. 段落以 {BATCH_MARK.format('k')} 编号标记开头时逐段翻译，每段译文前原样输出对应的编号标记。"""
+_CAPTION_TAG = "【图注】"
+_MARK_RE = re.compile(r'<<<(\d+)>>>')  # 与 BATCH_MARK 对应
+# 提示词指纹进缓存键：改了提示词即使忘记递增 PROMPT_VERSION，也不会命中旧译文
+_PROMPT_HASH = hashlib.sha256(_SYS_PROMPT.encode("utf-8")).hexdigest()[:16]
+_TEXT_SUBS = {r'\[': '$$', r'\]': '$$', r'\(': '$', r'\)': '$', '**': ''}
+_TEXT_RE = re.compile(r'\\[][()]|\*\*')
+
+def image_to_base64(jpeg_bytes):
+    return f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode('ascii')}"
+
+def image_to_file(jpeg_bytes, img_dir):
+    # 导出用：已编码的 JPEG 直接落盘 + 相对路径引用（HTML 写在同一目录），省掉 base64 的 4/3 膨胀；
+    # 按内容命名，重复的图只写一份、浏览器只解码一次
+    name = f"{hashlib.blake2b(jpeg_bytes, digest_size=8).hexdigest()}.jpg"
+    path = os.path.join(img_dir, name)
+    if not os.path.exists(path):
+        with open(path, "wb") as f: f.write(jpeg_bytes)
+    return name
+
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+_WORD_RE = re.compile(r"[A-Za-z]{4,}")
+_MATH_CHAR_RE = re.compile(r"[\\$]")
+_LATIN_RE = re.compile(r"[A-Za-z]")
+
+def _needs_translation(text):
+    # 不值得发请求的块：过短、已是中文、公式为主、没几个英文字母（编号、数字、符号串）
+    s = text.strip()
+    if len(s) < 2: return False
+    cjk = len(_CJK_RE.findall(s))
+    # 已是中文：没有英文单词，或汉字占非空白字符三成以上（中文单位署名、关键词行）
+    if cjk and (_WORD_RE.search(s) is None or cjk / len("".join(s.split())) > 0.3): return False
+    if len(_MATH_CHAR_RE.findall(s)) / len(s) > 0.15: return False
+    if len(_LATIN_RE.findall(s)) < 3: return False
+    return True
+
+# 值得重试的错误：限流、连接失败/超时（APITimeoutError 是 APIConnectionError 的子类）、服务端 5xx
+_RETRYABLE = (RateLimitError, APIConnectionError, InternalServerError)
+RETRY_MAX_WAIT = 30  # 单次退避上限（秒）
+
+def _retry_delay(e, attempt):
+    # 服务端给了 Retry-After（秒）就照它等，否则指数退避；断连类错误没有 response，同样走指数退避
+    try: wait = float(e.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError): wait = 0.5 * 2 ** attempt
+    return min(wait, RETRY_MAX_WAIT)
+
+class ClientPool:
+    # 每个 Key 一个客户端，请求间轮询；遇到 429、断连、超时、5xx 换下一个 Key 重试
+    def __init__(self, keys):
+        # 多 Key 时关掉 SDK 自带的同 Key 重试，由 create 换 Key 重试
+        retries = 0 if len(keys) > 1 else 2
+        # 所有 Key 共用一个连接池：同一主机，keep-alive 连接数与并发上限对齐；装了 h2 就走 HTTP/2 多路复用
+        # httpx 默认空闲 5 秒就断开，预览时两次点击之间往往更久，放宽到 KEEPALIVE_EXPIRY 免得重新握手
+        self.http = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(60, connect=10))
+        self.clients = [AsyncOpenAI(api_key=k, base_url=BASE_URL, max_retries=retries, http_client=self.http) for k in keys]
+        self._start = itertools.count()  # 每个请求的起始 Key 轮流取，重试时从起点依次往后换
+        # 信号量跟着常驻的客户端池走：跨页、跨会话统一调度，而不是每次导出各算各的
+        self.sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        # 译文缓存同样跟着常驻池走，跨会话共享一条 sqlite 连接
+        self.cache = TranslationCache(CACHE_PATH)
+        # 在途译文：缓存键 -> Future。并行的几页遇到同一段（页眉、署名、重复图注）只发一次请求
+        self.inflight = {}
+
+    async def create(self, **kwargs):
+        # 至少试 3 次，和单 Key 时 SDK 默认的 1 次 + 2 次重试一致
+        n = len(self.clients)
+        attempts = max(n, 3) if n > 1 else 1
+        # 起点 + 第几次 决定用哪个 Key：不和并发请求抢同一个轮询器，保证每次重试都换到另一个 Key
+        start = next(self._start)
+        for attempt in range(attempts):
+            try:
+                return await self.clients[(start + attempt) % n].chat.completions.create(**kwargs)
+            except _RETRYABLE as e:
+                if attempt == attempts - 1: raise
+                # 429 先立即换下一个 Key；所有 Key 轮过一遍仍被限流才退避。其它错误每次都退避
+                if isinstance(e, RateLimitError) and (attempt + 1) % n: continue
+                await asyncio.sleep(_retry_delay(e, attempt))
+
+    def close(self, loop):
+        # 进程退出时在所属循环上关掉连接池（正常断开 keep-alive 连接），再关 sqlite
+        try: asyncio.run_coroutine_threadsafe(self.http.aclose(), loop).result(timeout=5)
+        except Exception: pass
+        self.cache.close()
+
+@st.cache_resource
+def get_event_loop():
+    # 常驻后台事件循环：客户端连接池绑在它上面，跨请求、跨 rerun 复用 keep-alive 连接
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_client_pool(keys):
+    pool = ClientPool(list(keys))
+    atexit.register(pool.close, get_event_loop())
+    return pool
+
+def run_async(coro, progress_q=None, on_progress=None):
+    # 在常驻循环上执行协程；进度经队列回到脚本线程，Streamlit 控件只在脚本线程里更新
+    finished = threading.Event()
+
+    async def guarded():
+        try: return await coro
+        finally: finished.set()
+
+    fut = asyncio.run_coroutine_threadsafe(guarded(), get_event_loop())
+    try:
+        while progress_q is not None and not (fut.done() and progress_q.empty()):
+            try: on_progress(progress_q.get(timeout=0.2))
+            except queue.Empty: pass
+        return fut.result()
+    except BaseException:
+        # 脚本线程被中止（停止、重跑、刷新页面）或出错：协程一起取消，并等它真正收尾，
+        # 否则它还在后台占着 API 名额、往调用方已经删掉的临时目录里写
+        fut.cancel()
+        finished.wait()
+        raise
+
+def tag_caption(text, is_caption):
+    return _CAPTION_TAG + text if is_caption else text
+
+def untag_caption(text):
+    return text.strip().removeprefix(_CAPTION_TAG).strip()
+
+async def chat_complete(pool, user_msg):
+    # 流式接收：首个 token 生成即开始收包，连接不在整段生成期间空等
+    stream = await pool.create(
+        model=MODEL,
+        messages=[{"role": "system", "content": _SYS_PROMPT}, {"role": "user", "content": user_msg}],
+        temperature=0,  # 译文确定：同一原文每次结果一致，缓存复用才成立
+        stream=True
+    )
+    chunks = []
+    async for ev in stream:
+        if ev.choices: chunks.append(ev.choices[0].delta.content or "")
+    return "".join(chunks)
+
+async def translate_text_async(pool, text, is_caption=False):
+    # 请求失败返回 None，由调用方决定回退原文；译文与原文相同（参考文献、人名、网址）是正常结果
+    if not _needs_translation(text): return text
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": text}],
-            stream=False
-        )
-        return response.choices[0].message.content
-    except: return text
-
-def capture_image_between_blocks(page, prev_bottom, current_top):
-    if current_top - prev_bottom < 40: return None
-    rect = fitz.Rect(50, prev_bottom + 5, page.rect.width - 50, current_top - 5)
+        async with pool.sem:
+            reply = await chat_complete(pool, tag_caption(text, is_caption))
+        return untag_caption(reply)
+    except Exception: return None
+
+async def translate_batch_async(pool, texts, captions):
+    """多段合并成一次请求，每段前加编号标记，按编号拆回；缺失或为空的段单独重译，仍失败的段为 None。"""
+    if len(texts) == 1: return [await translate_text_async(pool, texts[0], captions[0])]
+    user_msg = "\n".join(f"{BATCH_MARK.format(i)}\n{tag_caption(t, c)}" for i, (t, c) in enumerate(zip(texts, captions)))
     try:
-        pix = page.get_pixmap(matrix=fitz.Matrix(3, 3), clip=rect, alpha=False)
-        img = Image.open(io.BytesIO(pix.tobytes("png")))
-        return img if img.size[1] >= 20 else None
-    except: return None
-
-def parse_page(page):
-    elements = []
-    blocks = page.get_text("blocks", sort=True)
-    last_bottom = 0
-    text_buffer = ""
-    valid_blocks = [b for b in blocks if not is_header_or_footer(fitz.Rect(b[:4]), page.rect.height)]
-    
-    for i, b in enumerate(valid_blocks):
-        b_rect = fitz.Rect(b[:4])
-        b_top = b_rect.y0
-        if i == 0 and last_bottom == 0: last_bottom = b_top
-
-        if is_caption_node(b[4]):
-            if text_buffer.strip():
-                elements.append({'type': 'text', 'content': translate_text(text_buffer)})
-                text_buffer = ""
-            img = capture_image_between_blocks(page, last_bottom, b_top)
-            if img: elements.append({'type': 'image', 'content': img})
-            elements.append({'type': 'caption', 'content': translate_text(b[4], True)})
+        async with pool.sem:
+            reply = await chat_complete(pool, user_msg)
+        parts = _MARK_RE.split(reply)
+        got = {int(k): untag_caption(v) for k, v in zip(parts[1::2], parts[2::2])}
+    except Exception: return [None] * len(texts)
+    # 按编号对齐：模型漏段、并段只影响对应的那几段，其余译文照用
+    missing = [i for i in range(len(texts)) if not got.get(i)]
+    redo = await asyncio.gather(*[translate_text_async(pool, texts[i], captions[i]) for i in missing])
+    got.update(zip(missing, redo))
+    return [got[i] for i in range(len(texts))]
+
+@dataclass
+class BatchQueue:
+    # 按字数/段数阈值把待译元素攒成批，每批只发一次请求
+    max_chars: int = BATCH_MAX_CHARS
+    max_items: int = BATCH_MAX_ITEMS
+    batches: list = field(default_factory=list)
+    _chars: int = 0
+
+    def push(self, el):
+        n = len(el['content'])
+        if not self.batches or len(self.batches[-1]) >= self.max_items or self._chars + n > self.max_chars:
+            self.batches.append([])
+            self._chars = 0
+        self.batches[-1].append(el)
+        self._chars += n
+
+def cache_key(text, is_caption):
+    # 段内空白归一（保留段落分隔），只差换行/多空格的重复块也能命中
+    norm = "\n\n".join(" ".join(p.split()) for p in text.split("\n\n"))
+    return hashlib.sha256(f"{MODEL}|{PROMPT_VERSION}|{_PROMPT_HASH}|{int(is_caption)}|{norm}".encode("utf-8")).hexdigest()
+
+class LRUCache:
+    # 只在事件循环线程里访问，不加锁
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+
+    def get_many(self, keys):
+        hits = {}
+        for k in keys:
+            if k in self._d:
+                self._d.move_to_end(k)
+                hits[k] = self._d[k]
+        return hits
+
+    def put_many(self, items):
+        for k, v in items:
+            if len(v) > MEMO_MAX_CHARS: continue
+            self._d[k] = v
+            self._d.move_to_end(k)
+        while len(self._d) > self.maxsize: self._d.popitem(last=False)
+
+    def clear(self):
+        self._d.clear()
+
+class TranslationCache:
+    # 两级译文缓存：进程内 LRU 挡在 sqlite 前面；sqlite 连接常驻、跨线程共用，读写都加锁
+    def __init__(self, path):
+        self.memo = LRUCache(MEMO_SIZE)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tcache (k TEXT PRIMARY KEY, v TEXT)")
+
+    def get_many(self, keys):
+        hits = self.memo.get_many(keys)
+        missing = [k for k in keys if k not in hits]
+        disk = {}
+        with self._lock:
+            # 一次 IN 查询代替逐键 SELECT；分段避开 SQLite 的参数个数上限
+            for i in range(0, len(missing), 500):
+                part = missing[i:i + 500]
+                disk.update(self._conn.execute(
+                    f"SELECT k, v FROM tcache WHERE k IN ({','.join('?' * len(part))})", part).fetchall())
+        self.memo.put_many(disk.items())
+        hits.update(disk)
+        return hits
+
+    def put_many(self, items):
+        if not items: return
+        self.memo.put_many(items)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO tcache (k, v) VALUES (?, ?)", items)
+
+    def clear(self):
+        self.memo.clear()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tcache")
+
+    def close(self):
+        with self._lock: self._conn.close()
+
+class PartialTranslation(Exception):
+    # 有段落的请求失败、暂用原文：页面照常显示，但不能进 st.cache_data，下次点击要重新请求
+    def __init__(self, result):
+        super().__init__("部分段落翻译失败")
+        self.result = result
+
+async def translate_elements(pool, elements):
+    """合批并发翻译所有 text/caption 元素（原地替换 content），信号量限制在途请求数；全部译成返回 True。"""
+    jobs = [el for el in elements if el['type'] in ('text', 'caption') and _needs_translation(el['content'])]
+    # 按缓存键去重：重复的图注、标签、多栏重复块只翻译一次，再回填到每个副本
+    groups = {}
+    for el in jobs: groups.setdefault(cache_key(el['content'], el['type'] == 'caption'), []).append(el)
+    hits = pool.cache.get_many(list(groups))
+    loop = asyncio.get_running_loop()
+    batcher = BatchQueue()
+    rep_keys, waiting, owned = {}, {}, {}
+    failed = 0
+    for k, els in groups.items():
+        if k in hits:
+            for el in els: el['content'] = hits[k]
+        elif k in pool.inflight:
+            waiting[k] = pool.inflight[k]  # 别的页已在翻同一段，等它的结果
         else:
-            text_buffer += b[4] + "\n\n"
-        last_bottom = b_rect.y1
-        
-    if text_buffer.strip():
-        elements.append({'type': 'text', 'content': translate_text(text_buffer)})
-    return elements
+            rep_keys[id(els[0])] = k
+            batcher.push(els[0])
+            owned[k] = pool.inflight[k] = loop.create_future()
+    try:
+        results = await asyncio.gather(*[
+            translate_batch_async(pool, [el['content'] for el in batch], [el['type'] == 'caption' for el in batch])
+            for batch in batcher.batches
+        ])
+        fresh = []
+        for batch, trans in zip(batcher.batches, results):
+            for el, t in zip(batch, trans):
+                k = rep_keys[id(el)]
+                owned[k].set_result(t)
+                # 请求失败（None）：保留原文、不写缓存；其余译文哪怕和原文一样也照常缓存
+                if t is None:
+                    failed += 1
+                    continue
+                fresh.append((k, t))
+                for dup in groups[k]: dup['content'] = t
+        pool.cache.put_many(fresh)
+    finally:
+        # 出错或被取消时也要放行等待方：拿不到译文按失败处理，等待方保留原文
+        for k, fut in owned.items():
+            if not fut.done(): fut.set_result(None)
+            pool.inflight.pop(k, None)
+    for k, fut in waiting.items():
+        t = await fut
+        if t is None:
+            failed += 1
+            continue
+        for el in groups[k]: el['content'] = t
+    return failed == 0
+
+@st.cache_data(show_spinner=False)
+def pdf_page_count(pdf_key, _pdf_bytes):
+    # 主脚本只需要页数：按文件摘要缓存，同一文件重跑时不再解析整份 PDF
+    with fitz.open(stream=_pdf_bytes, filetype="pdf") as doc:
+        return len(doc)
+
+@st.cache_data(show_spinner=False)
+def page_has_images(pdf_key, page_num, _pdf_bytes):
+    # 不含位图的纯文字/矢量页 PNG 更清晰也不大；带照片的页用 JPEG，体积小一个数量级
+    with fitz.open(stream=_pdf_bytes, filetype="pdf") as doc:
+        return bool(doc[page_num-1].get_images())
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def render_page_preview(pdf_key, page_num, dpi, quality, gray, _pdf_bytes):
+    # 原文预览图按 (文件摘要, 页码, DPI, 质量, 灰度) 缓存；_pdf_bytes 以下划线开头，不参与哈希
+    # quality 为 None 时输出 PNG（无位图的页），否则按该质量输出 JPEG
+    with fitz.open(stream=_pdf_bytes, filetype="pdf") as doc:
+        pix = render_page_image(doc[page_num-1], dpi, gray)
+    fitz.TOOLS.store_shrink(100)
+    return pix.tobytes("png") if quality is None else pix.tobytes("jpeg", jpg_quality=quality)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def parse_page(pdf_key, page_num, prompt_version, _pdf_bytes):
+    # 单页译文按 (文件摘要, 页码, 提示词版本) 缓存：调滑块、切模式等重跑不再重复解析和请求 API
+    # 版面 → 翻译 → 截图依次进行：MuPDF 光栅化时并不释放 GIL，和翻译并行只会拖慢所有会话共用的事件循环线程
+    with fitz.open(stream=_pdf_bytes, filetype="pdf") as doc:
+        page = doc[page_num-1]
+        els = layout_page(page)
+        complete = run_async(translate_elements(get_client_pool(tuple(API_KEYS)), els))
+        els = fill_images(page, els)
+    # 文档已关闭，它在 MuPDF 全局 store 里留下的解码图像、字体等都用不上了，立即释放
+    fitz.TOOLS.store_shrink(100)
+    # 有段落请求失败时抛出而不是返回：异常结果不会被 st.cache_data 记住，再点一次就重新请求
+    if not complete: raise PartialTranslation(els)
+    return els
+
+@functools.lru_cache(maxsize=1)
+def worker_context():
+    # 服务进程是多线程的（Streamlit 各会话、事件循环、Chrome 读线程），直接 fork 可能把别的线程持有的锁、
+    # 正在用的 MuPDF 状态一起复制进子进程。worker 改由 forkserver 派生（没有就 spawn），只导入 pdf_layout
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    # forkserver 先把 fitz/numpy 导入好，之后每个 worker 从它 fork，不必每次冷启动
+    if ctx.get_start_method() == "forkserver": ctx.set_forkserver_preload(["pdf_layout"])
+    return ctx
+
+def page_executor(pdf_bytes, n_pages):
+    # 进程数不超过页数：导出一两页时不白白起一批 worker 再各自打开整份 PDF；
+    # 启动参数要 pickle 给子进程，上传缓冲区的 memoryview 先转成 bytes
+    return ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 4, n_pages), mp_context=worker_context(),
+                               initializer=open_worker_doc, initargs=(bytes(pdf_bytes),))
+
+async def process_pages(pool, pdf_bytes, page_nums, progress_q=None, on_page=None):
+    """批量导出：进程池解析版面，主进程异步翻译，渲染与网络等待互相重叠。"""
+    page_sem = asyncio.Semaphore(PAGE_CONCURRENCY)
+    results = {}
 
-def clean_latex(text):
-    return text.replace(r'\[', '$$').replace(r'\]', '$$').replace(r'\(', '$').replace(r'\)', '$')
+    async def consume(fut):
+        page_num, els = await fut
+        # 页间并行但限量：先解析完的页先占名额，后面的页排队，进度条前进更平滑
+        async with page_sem:
+            await translate_elements(pool, els)
+            results[page_num] = els
+        if on_page: on_page(page_num, results[page_num])
+        if progress_q is not None: progress_q.put(len(results))
+
+    def start():
+        # 首次提交时才拉起 forkserver 和各 worker，耗时可达秒级：放到线程里做，不卡所有会话共用的事件循环
+        ex = page_executor(pdf_bytes, len(page_nums))
+        return ex, [ex.submit(extract_worker_page, p) for p in page_nums]
+
+    starting = asyncio.ensure_future(asyncio.to_thread(start))
+    try: ex, futs = await asyncio.shield(starting)
+    except asyncio.CancelledError:
+        # 启动线程没法中途打断：等池起来后立即关掉，不留下没人管的 worker 进程
+        starting.add_done_callback(lambda f: f.exception() or f.result()[0].shutdown(wait=False, cancel_futures=True))
+        raise
+    try:
+        await asyncio.gather(*[consume(asyncio.wrap_future(f)) for f in futs])
+    except BaseException:
+        # 被取消或出错：排队的页不再解析，也不在循环线程上干等正在跑的 worker
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    # 正常结束时等 worker 进程退出同样放到线程里
+    await asyncio.to_thread(ex.shutdown)
+    return [results[p] for p in page_nums]
+
+def clean_text(text):
+    # LaTeX 定界符换成 $/$$、去掉 Markdown 加粗，整块一趟替换，不再逐段 replace
+    if '\\' not in text and '**' not in text: return text  # 纯文本段落最常见，直接原样返回
+    return _TEXT_RE.sub(lambda m: _TEXT_SUBS[m.group()], text)
+
+# 文档头尾是常量，模块加载时拼好一次，生成时只做一次 join
+# 没有公式的文档不加载 MathJax：省掉脚本下载和排版等待
+_HEAD = "<!DOCTYPE html><html><head><meta charset='utf-8'>{}</head><body><div class=\"page-container\">"
+_PREVIEW_HEAD = _HEAD.format(COMMON_CSS + MATHJAX_SCRIPT)
+_EXPORT_HEAD = _HEAD.format(COMMON_CSS + EXPORT_MATHJAX_SCRIPT)
+_PLAIN_HEAD = _HEAD.format(COMMON_CSS)
+_TAIL = "</div></body></html>"
 
 # --- 3. HTML 构建器 (关键：这里不加封面，保持纯净) ---
-def generate_full_html(all_pages_data, filename="Document"):
+def generate_full_html(all_pages_data, filename="Document", img_dir=None):
     # 纯净版 PDF：不加任何“白水制作”的 Header
-    html_body = f'<div class="page-container">'
+    # img_dir 为空时图片内联 base64（网页预览用），否则写成同目录下的相对文件引用（导出 PDF 用，HTML 须写在 img_dir 里）
+    parts = [None]
+    has_math = False
     
     for idx, page_els in enumerate(all_pages_data):
         page_class = "page-break first-page" if idx == 0 else "page-break"
-        html_body += f'<div class="{page_class}">- {idx+1} -</div>'
+        parts.append(f'<div class="{page_class}">- {idx+1} -</div>')
         
         for el in page_els:
             if el['type'] == 'text':
-                paras = clean_latex(el['content']).split('\n\n')
-                for p in paras:
-                    if p.strip(): html_body += f"<p>{p.strip().replace('**', '')}</p>"
+                text = clean_text(el['content'])
+                has_math = has_math or '$' in text
+                for p in text.split('\n\n'):
+                    p = p.strip()
+                    if p: parts.append(f"<p>{p}</p>")
             elif el['type'] == 'image':
-                html_body += f'<img src="{image_to_base64(el["content"])}" />'
+                src = image_to_file(el["content"], img_dir) if img_dir else image_to_base64(el["content"])
+                parts.append(f'<img src="{src}" />')
             elif el['type'] == 'caption':
-                html_body += f'<div class="caption">{el["content"]}</div>'
+                has_math = has_math or '$' in el['content'] or '\\(' in el['content']
+                parts.append(f'<div class="caption">{el["content"]}</div>')
                 
-    html_body += "</div>"
-    return f"<!DOCTYPE html><html><head><meta charset='utf-8'>{COMMON_CSS}{MATHJAX_SCRIPT}</head><body>{html_body}</body></html>"
+    parts[0] = (_EXPORT_HEAD if img_dir else _PREVIEW_HEAD) if has_math else _PLAIN_HEAD
+    parts.append(_TAIL)
+    return "".join(parts)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def preview_page_html(pdf_key, page_num, prompt_version, _pdf_bytes):
+    # 预览页 HTML（含 base64 插图）整段缓存：拖滑块、翻页回来等 rerun 不再重复编码拼接；没翻全的页同样不缓存
+    try: return generate_full_html([parse_page(pdf_key, page_num, prompt_version, _pdf_bytes)])
+    except PartialTranslation as e: raise PartialTranslation(generate_full_html([e.result]))
 
 # --- 4. PDF 引擎 ---
+@functools.lru_cache(maxsize=1)
 def get_chrome_path():
-    if shutil.which("chromium"): return shutil.which("chromium")
-    if shutil.which("chromium-browser"): return shutil.which("chromium-browser")
+    # 浏览器位置进程内不会变：探测一次，之后每次导出直接取结果
+    for name in ("chromium", "chromium-browser"):
+        path = shutil.which(name)
+        if path: return path
     # Mac/Win paths...
-    mac_paths = ["/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"]
-    for p in mac_paths: 
-        if os.path.exists(p): return p
-    win_paths = [r"C:\Program Files\Google\Chrome\Application\chrome.exe"]
-    for p in win_paths: 
+    for p in ("/Applications/Google Chrome.app/Contents/MacOS/Google Chrome",
+              r"C:\Program Files\Google\Chrome\Application\chrome.exe"):
         if os.path.exists(p): return p
     return None
 
-def html_to_pdf_with_chrome(html_content, output_pdf_path):
+def chrome_base_args(chrome_bin):
+    args = [chrome_bin, "--headless", "--disable-gpu"]
+    # 容器里 /dev/shm 常只有 64MB，大文档会把渲染进程撑崩，改用 /tmp
+    if platform.system() == "Linux": args[1:1] = ["--no-sandbox", "--disable-dev-shm-usage"]
+    return args
+
+def html_to_pdf_with_chrome(html_content, work_dir):
+    # 成功时返回 (True, PDF 字节)；HTML 写进调用方的临时目录（和插图放一起），随目录一起清理
     chrome_bin = get_chrome_path()
     if not chrome_bin:
         return False, "❌ 未找到浏览器核心，请检查 packages.txt"
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".html", mode="w", encoding="utf-8") as tmp_html:
-        tmp_html.write(html_content)
-        tmp_html_path = tmp_html.name
+    tmp_html_path = os.path.join(work_dir, "doc.html")
+    with open(tmp_html_path, "w", encoding="utf-8") as f: f.write(html_content)
+    # 规范化的 file:// URI：路径里的空格、中文等特殊字符已转义
+    url = pathlib.Path(tmp_html_path).as_uri()
 
-    cmd = [
-        chrome_bin, "--headless", "--disable-gpu", 
+    output_pdf_path = os.path.join(work_dir, "doc.pdf")
+    cmd = chrome_base_args(chrome_bin) + [
         f"--print-to-pdf={output_pdf_path}",
+        # 各段并行打印时各用各的配置目录，避免抢同一个 profile 锁
+        f"--user-data-dir={os.path.join(work_dir, 'profile')}",
         "--no-pdf-header-footer", 
-        "--virtual-time-budget=8000",
-        f"file://{tmp_html_path}"
+        # 没有 MathJax 时只需等图片和字体，预算放短
+        f"--virtual-time-budget={8000 if 'MathJax-script' in html_content else 2000}",
+        url
     ]
-    if platform.system() == "Linux": cmd.insert(1, "--no-sandbox")
 
     try:
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return True, "Success"
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=CHROME_TIMEOUT)
+        with open(output_pdf_path, "rb") as f: return True, f.read()
+    except subprocess.TimeoutExpired:
+        return False, f"⏱️ Chrome 打印超时（{CHROME_TIMEOUT} 秒）"
+    except Exception as e:
+        return False, str(e)
+
+@st.cache_resource
+def _page_in_chrome(chrome_bin):
+    # 后台跑一次 --version，把浏览器二进制读进系统页缓存，首次导出少一次冷盘读取
+    threading.Thread(target=subprocess.run, args=([chrome_bin, "--version"],),
+                     kwargs=dict(capture_output=True, timeout=5), daemon=True).start()
+
+def prewarm_chrome():
+    # 进入导出页就预读浏览器二进制
+    chrome_bin = get_chrome_path()
+    if chrome_bin: _page_in_chrome(chrome_bin)
+
+def html_to_pdf_with_weasyprint(html_content, work_dir):
+    # 进程内渲染，省掉浏览器冷启动和 virtual-time-budget 等待；不执行 JS，公式保留 $...$ 原文
+    if WeasyHTML is None:
+        return False, "❌ 未安装 weasyprint"
+    try:
+        return True, WeasyHTML(string=html_content, base_url=work_dir + os.sep).write_pdf(presentational_hints=True)
     except Exception as e:
         return False, str(e)
 
+PDF_ENGINES = {"chrome": "Chromium（MathJax 排版公式）", "weasyprint": "WeasyPrint（更快，公式保留原文）"}
+
+def available_engines():
+    engines = [e for e, ok in (("chrome", get_chrome_path()), ("weasyprint", WeasyHTML)) if ok]
+    return engines or ["chrome"]
+
+def html_to_pdf(html_content, work_dir, engine=None):
+    # 默认优先 Chrome（MathJax 排版公式）；用户选了 WeasyPrint 或找不到浏览器时走进程内渲染
+    engine = engine or available_engines()[0]
+    if engine == "weasyprint":
+        return html_to_pdf_with_weasyprint(html_content, work_dir)
+    return html_to_pdf_with_chrome(html_content, work_dir)
+
+def print_chunk(chunk_data, work_dir, engine):
+    # 打印线程里执行；每段一个子目录，插图和 HTML 文件名互不冲突
+    part_dir = tempfile.mkdtemp(dir=work_dir)
+    return html_to_pdf(generate_full_html(chunk_data, img_dir=part_dir), part_dir, engine)
+
+def merge_pdfs(parts):
+    with fitz.open() as out:
+        for b in parts:
+            with fitz.open(stream=b, filetype="pdf") as part: out.insert_pdf(part)
+        return out.tobytes()
+
+async def export_pdf(pool, pdf_bytes, page_nums, work_dir, engine, progress_q=None):
+    """导出流水线：按页序凑满一段就交给打印线程，打印与后续页的解析、翻译重叠，最后合并各段 PDF。
+
+    只有分了段才有重叠：WeasyPrint 总是分段；Chrome 要到 PRINT_SPLIT_PAGES 页以上才拆段，
+    更小的导出只有一段，等全部页翻译完才打印。
+    """
+    if not page_nums: return False, "没有要导出的页"
+    loop = asyncio.get_running_loop()
+    # WeasyPrint 分段打印几乎没有额外开销；一次性 Chrome 进程每段都要冷启动，小文档只打一次，
+    # 大文档均分成 PRINT_WORKERS 段，各起一个进程同时打印
+    if engine == "weasyprint": chunk = PRINT_CHUNK_PAGES
+    elif len(page_nums) >= PRINT_SPLIT_PAGES: chunk = -(-len(page_nums) // PRINT_WORKERS)
+    else: chunk = len(page_nums)
+    results, prints = {}, []
+    next_idx = 0
+
+    def on_page(page_num, els):
+        nonlocal next_idx
+        results[page_num] = els
+        while next_idx < len(page_nums):
+            span = page_nums[next_idx:next_idx + chunk]
+            if not all(p in results for p in span): break
+            prints.append(loop.run_in_executor(printer, print_chunk, [results[p] for p in span], work_dir, engine))
+            next_idx += len(span)
+
+    # Chrome 每段各开一个标签页（或独立进程），可以几段同时打印；WeasyPrint 不保证线程安全，保持单线程
+    # 结果按提交顺序收集，合并时页序不乱
+    printer = ThreadPoolExecutor(max_workers=PRINT_WORKERS if engine == "chrome" else 1)
+    try:
+        await process_pages(pool, pdf_bytes, page_nums, progress_q, on_page)
+        outs = await asyncio.gather(*prints)
+        failed = next((msg for ok, msg in outs if not ok), None)
+        # 合并要把各段 PDF 整个重写一遍，同样交给打印线程，不占事件循环
+        if not failed and len(outs) > 1: merged = await loop.run_in_executor(printer, merge_pdfs, [b for _, b in outs])
+    except BaseException:
+        # 被取消或出错：还没开打的段直接丢弃，已经在打的段要等它结束，work_dir 才能交还给调用方删除
+        printer.shutdown(wait=False, cancel_futures=True)
+        await asyncio.to_thread(printer.shutdown)
+        raise
+    printer.shutdown()
+    if failed: return False, failed
+    return True, outs[0][1] if len(outs) == 1 else merged
+
 # --- 5. 界面逻辑 (关键：这里恢复你的名字！) ---
 # 界面大标题：保留“光学室专用版”
 st.title("🔬 光学室学术论文翻译专用版")
@@ -229,55 +732,81 @@ with st.sidebar:
     uploaded_file = st.file_uploader("上传 PDF", type="pdf")
     st.markdown("---")
     mode = st.radio("功能模式", ["👁️ 实时预览", "🖨️ 导出 PDF"])
+    if st.button("🧹 清空译文缓存"):
+        # LRU 只在事件循环线程里动，清理也投递到循环上做；已解析的页缓存一并作废，下次重新翻译
+        get_event_loop().call_soon_threadsafe(get_client_pool(tuple(API_KEYS)).cache.clear)
+        parse_page.clear()
+        preview_page_html.clear()
+        st.toast("译文缓存已清空")
 
 if uploaded_file:
-    pdf_bytes = uploaded_file.read()
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    # getbuffer() 是上传缓冲区的零拷贝 memoryview，不再 read() 出一份完整副本
+    pdf_bytes = uploaded_file.getbuffer()
+    # 摘要按上传记录缓存在会话里：同一份文件的后续 rerun 不再把整份 PDF 重新哈希一遍
+    file_id = getattr(uploaded_file, "file_id", None)
+    if file_id is None or st.session_state.get('pdf_file_id') != file_id:
+        st.session_state['pdf_file_id'] = file_id
+        st.session_state['pdf_key'] = hashlib.blake2b(pdf_bytes, digest_size=8).digest()
+    pdf_key = st.session_state['pdf_key']
+    n_pages = pdf_page_count(pdf_key, pdf_bytes)
     
     if mode == "👁️ 实时预览":
         with st.sidebar:
             st.markdown("---")
-            page_num = st.number_input("页码", 1, len(doc), 1)
+            page_num = st.number_input("页码", 1, n_pages, 1)
+            preview_dpi = st.slider("预览清晰度 (DPI)", 72, 216, PREVIEW_DPI, 12)
+            # 只有带位图、按 JPEG 输出的页才有质量可调；纯文字/矢量页走 PNG，不显示这个滑块
+            if page_has_images(pdf_key, page_num, pdf_bytes):
+                preview_quality = st.slider("预览 JPEG 质量", 50, 95, PREVIEW_QUALITY, 5)
+            else:
+                preview_quality = None
+                st.caption("本页无位图，预览为 PNG 无损图")
+            preview_gray = st.toggle("灰度预览", value=False)
             if st.button("🔄 翻译此页", type="primary"):
                 st.session_state['run_preview'] = True
         
         c1, c2 = st.columns([1, 1.2])
         with c1:
             st.subheader("原文")
-            pix = doc[page_num-1].get_pixmap(matrix=fitz.Matrix(2,2))
-            st.image(pix.tobytes("png"), use_container_width=True)
+            st.image(render_page_preview(pdf_key, page_num, preview_dpi, preview_quality, preview_gray, pdf_bytes), use_container_width=True)
         with c2:
             st.subheader("译文预览")
             if st.session_state.get('run_preview'):
                 with st.spinner("AI 解析中..."):
-                    els = parse_page(doc[page_num-1])
-                    preview_html = generate_full_html([els])
+                    try: preview_html = preview_page_html(pdf_key, page_num, PROMPT_VERSION, pdf_bytes)
+                    except PartialTranslation as e:
+                        preview_html = e.result
+                        st.warning("部分段落翻译失败，暂显示原文；页面下次刷新时会重新请求")
                     components.html(preview_html, height=800, scrolling=True)
 
     else:
         st.subheader("📄 批量导出 (纯净版)")
         c1, c2 = st.columns(2)
-        with c1: start = st.number_input("起始页", 1, len(doc), 1)
-        with c2: end = st.number_input("结束页", 1, len(doc), min(3, len(doc)))
+        with c1: start = st.number_input("起始页", 1, n_pages, 1)
+        with c2: end = st.number_input("结束页", 1, n_pages, min(3, n_pages))
+        engines = available_engines()
+        engine = st.selectbox("PDF 引擎", engines, format_func=PDF_ENGINES.get) if len(engines) > 1 else engines[0]
+        if engine == "chrome": prewarm_chrome()
         
-        if st.button("🚀 生成 PDF", type="primary"):
-            data = []
+        if start > end:
+            st.error("起始页不能大于结束页")
+        elif st.button("🚀 生成 PDF", type="primary"):
             bar = st.progress(0)
             status = st.empty()
-            
-            for i, p in enumerate(range(start, end + 1)):
-                status.text(f"正在处理第 {p} 页...")
-                data.append(parse_page(doc[p-1]))
-                bar.progress((i+1) / (end-start+1))
-            
-            status.text("正在合成纯净文档...")
-            full_html = generate_full_html(data, filename=uploaded_file.name)
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-                ok, msg = html_to_pdf_with_chrome(full_html, tmp_pdf.name)
-                if ok:
-                    status.success("✅ 完成！")
-                    with open(tmp_pdf.name, "rb") as f:
-                        st.download_button("📥 下载翻译报告", f, "Translated_Paper.pdf")
-                else:
-                    st.error(f"失败: {msg}")
+            total = end - start + 1
+
+            def on_page_done(done):
+                status.text(f"已完成 {done}/{total} 页..." if done < total else "正在合成纯净文档...")
+                bar.progress(done / total)
+
+            status.text("正在解析、翻译并分段排版...")
+            progress_q = queue.Queue()
+            # 插图和 HTML 放同一个临时目录，打印完整体删除；PDF 以字节交给下载按钮，不留临时文件
+            with tempfile.TemporaryDirectory() as work_dir:
+                ok, result = run_async(export_pdf(get_client_pool(tuple(API_KEYS)), pdf_bytes, list(range(start, end + 1)), work_dir, engine, progress_q),
+                                       progress_q, on_page_done)
+            if ok:
+                status.success("✅ 完成！")
+                st.download_button("📥 下载翻译报告", result, "Translated_Paper.pdf")
+            else:
+                st.error(f"失败: {result}")
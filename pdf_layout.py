@@ -0,0 +1,149 @@
+"""版面解析与插图截取：不依赖 Streamlit，导出用的 worker 进程只导入这个模块，不会执行界面脚本。"""
+import fitz  # PyMuPDF
+import numpy as np
+import re
+import functools
+import threading
+
+FIGURE_DPI = 144  # 插图渲染分辨率，打印半幅 A4 足够清晰
+FIGURE_QUALITY = 85  # 插图裁切的 JPEG 质量
+NUMPY_MIN_BLOCKS = 100  # 块数超过此值才走向量化过滤，小页面 Python 循环反而更快
+
+def dpi_matrix(dpi):
+    zoom = dpi / 72.0
+    return fitz.Matrix(zoom, zoom)
+
+def is_header_or_footer(y0, y1, page_height):
+    return y1 < 50 or y0 > page_height - 50
+
+_CAP_RE = re.compile(r'Figure\s?\d+[.:]')
+
+def header_footer_keep_mask(blocks, page_height):
+    # 整页坐标一次向量比较，等价于逐块 not is_header_or_footer；fromiter 直接填数组，不建中间元组列表
+    n = len(blocks)
+    y0 = np.fromiter((b[1] for b in blocks), dtype=np.float32, count=n)
+    y1 = np.fromiter((b[3] for b in blocks), dtype=np.float32, count=n)
+    return ((y1 >= 50) & (y0 <= page_height - 50)).tolist()
+
+def is_caption_node(text):
+    # startswith 先筛：绝大多数正文块一次 C 调用就排除，只有 "Figure" 开头的才跑正则
+    t = text.lstrip()
+    if t.startswith("Fig."): return True
+    return t.startswith("Figure") and _CAP_RE.match(t) is not None
+
+def render_page_image(page, dpi, gray=False):
+    # 灰度只给左栏预览用（单通道，像素缓冲和编码量都是 RGB 的 1/3）；导出截图始终 RGB
+    return page.get_pixmap(matrix=dpi_matrix(dpi), colorspace=fitz.csGRAY if gray else fitz.csRGB, alpha=False)
+
+class PageAssets:
+    # 截图要用到的整页位图、图形外框、内嵌位图信息：按需计算，一页只算一次，没有图注就一样都不算
+    def __init__(self, page):
+        self.page = page
+
+    @functools.cached_property
+    def pixmap(self):
+        return render_page_image(self.page, FIGURE_DPI)
+
+    @functools.cached_property
+    def drawn(self):
+        # 页面上所有绘制操作（含文字）的类型和外框，一次 C 调用拿到，不做任何光栅化
+        return [(kind, fitz.Rect(bbox)) for kind, bbox in self.page.get_bboxlog()]
+
+    @functools.cached_property
+    def graphics(self):
+        # 非文字绘制：位图、矢量路径
+        return [(kind, r) for kind, r in self.drawn if not kind.endswith("-text")]
+
+    @functools.cached_property
+    def images(self):
+        return self.page.get_image_info(xrefs=True)
+
+def embedded_jpeg(page, bbox, assets):
+    # 缝隙里只有一张端正摆放、无透明蒙版、分辨率不过高的 JPEG 时，直接取 PDF 里的原始码流：不渲染、不重编码
+    for info in assets.images:
+        if not info["xref"] or max(abs(u - v) for u, v in zip(info["bbox"], bbox)) > 1: continue
+        a, b, c, d = info["transform"][:4]
+        if b or c or a <= 0 or d <= 0: return None
+        img = page.parent.extract_image(info["xref"])
+        if img.get("smask") or img["ext"] not in ("jpeg", "jpg") or img["colorspace"] not in (1, 3): return None
+        if img["width"] > 2 * bbox.width * FIGURE_DPI / 72: return None
+        return img["image"]
+    return None
+
+def capture_image_between_blocks(page, prev_bottom, current_top, assets):
+    # 从整页位图里按坐标裁切，同一页多张图只光栅化一次；裁切和 JPEG 编码都在 MuPDF 里完成，不经过 PIL
+    if current_top - prev_bottom < 40: return None
+    rect = fitz.Rect(50, prev_bottom + 5, page.rect.width - 50, current_top - 5)
+    # 把整条缝隙都盖住的图形是页面底色、版心底框之类的背景，不算插图，也不参与下面的裁切范围
+    hits = [(kind, g) for kind, g in assets.graphics if g.intersects(rect) and not g.contains(rect)]
+    # 空白间隙里没有任何图形就不渲染整页
+    if not hits: return None
+    try:
+        if len(hits) == 1 and hits[0][0] == "fill-image" and fitz.Rect(0, prev_bottom, page.rect.width, current_top).contains(hits[0][1]):
+            raw = embedded_jpeg(page, hits[0][1], assets)
+            if raw: return raw
+        # 裁到缝隙里实际画了东西的范围（连同图里的文字标注），窄图不再带着整条空白一起编码
+        boxes = [g for _, g in assets.drawn if g.intersects(rect) and not g.contains(rect)]
+        rect &= fitz.Rect(min(b.x0 for b in boxes) - 4, min(b.y0 for b in boxes) - 4,
+                          max(b.x1 for b in boxes) + 4, max(b.y1 for b in boxes) + 4)
+        page_pix = assets.pixmap
+        clip = (rect * dpi_matrix(FIGURE_DPI)).round() & page_pix.irect
+        if clip.height < 20: return None
+        pix = fitz.Pixmap(fitz.csRGB, clip, False)
+        pix.copy(page_pix, clip)
+        return pix.tobytes("jpeg", jpg_quality=FIGURE_QUALITY)
+    except: return None
+
+def layout_page(page):
+    """版面解析：切分正文/图片/图注，只保留原文，不调用 API；插图只记下位置，由 fill_images 截取。"""
+    elements = []
+    # 只要文字块（b[6]==0），顺带在 C 层做断词连字符合并，译文更干净、token 更少
+    blocks = page.get_text("blocks", sort=True, flags=fitz.TEXTFLAGS_TEXT | fitz.TEXT_DEHYPHENATE)
+    blocks = [b for b in blocks if b[6] == 0]
+    last_bottom = 0
+    text_buffer = []  # 攒块列表，刷新时一次 join，不做逐块 += 拼接
+    page_h = page.rect.height
+
+    # 块元组自带 (x0, y0, x1, y1, text, ...)，直接取 y0/y1，整页不建一个 Rect
+    if len(blocks) > NUMPY_MIN_BLOCKS:
+        blocks = [b for b, keep in zip(blocks, header_footer_keep_mask(blocks, page_h)) if keep]
+    else:
+        blocks = [b for b in blocks if not is_header_or_footer(b[1], b[3], page_h)]
+    
+    for i, (_, b_top, _, b_bottom, b_text, *_) in enumerate(blocks):
+        if i == 0 and last_bottom == 0: last_bottom = b_top
+
+        if is_caption_node(b_text):
+            if any(t.strip() for t in text_buffer):
+                elements.append({'type': 'text', 'content': "\n\n".join(text_buffer)})
+            text_buffer.clear()
+            elements.append({'type': 'image', 'content': None, 'gap': (last_bottom, b_top)})
+            elements.append({'type': 'caption', 'content': b_text})
+        else:
+            text_buffer.append(b_text)
+        last_bottom = b_bottom
+        
+    if any(t.strip() for t in text_buffer):
+        elements.append({'type': 'text', 'content': "\n\n".join(text_buffer)})
+    return elements
+
+def fill_images(page, elements):
+    # 按 layout_page 记下的位置截图，返回去掉空插图后的新列表；只改 image 元素，可与翻译并行
+    assets = PageAssets(page)
+    for el in elements:
+        if el['type'] == 'image':
+            el['content'] = capture_image_between_blocks(page, *el.pop('gap'), assets)
+    return [el for el in elements if el['type'] != 'image' or el['content']]
+
+_worker = threading.local()
+
+def open_worker_doc(pdf_bytes):
+    # 每个 worker 只打开一次文档（fitz.Document 不跨线程共享），任务只传页码，不再每页 pickle 整份 PDF
+    _worker.doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+def extract_worker_page(page_num):
+    page = _worker.doc[page_num-1]
+    els = fill_images(page, layout_page(page))
+    # 页与页之间互不依赖：每页做完清空 store，worker 常驻内存保持在一页的量，不随页数增长
+    fitz.TOOLS.store_shrink(100)
+    return page_num, els